@@ -1,47 +1,345 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file
+from flask import Blueprint, Flask, current_app, g, render_template, request, redirect, url_for, jsonify, send_file
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from datetime import datetime, timedelta
-from flask_mail import Mail, Message
-from dotenv import load_dotenv
 import os
 import json
-import telnyx
-from sqlalchemy import or_, desc, asc
+import time
+import zlib
+import base64
+import binascii
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, func, or_, desc, asc
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.types import TypeDecorator, Text
 from werkzeug.utils import secure_filename
 from calendar import monthrange
 
-load_dotenv()  # Cargar variables de entorno
+# telnyx, flask_mail y dotenv se importan al usarse por primera vez para
+# que el arranque de cada worker sea rápido.
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
-app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT'))
-app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS') == 'True'
-app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
-app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
-app.config['TELNYX_API_KEY'] = os.getenv('TELNYX_API_KEY')
-telnyx.api_key = app.config['TELNYX_API_KEY']
+class SesionAgencias(Session):
+    """Envía las consultas de las agencias con base de datos propia a su bind."""
 
-db = SQLAlchemy(app)
-mail = Mail(app)
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            clave = bind_de_agencia(g.get('agencia'))
+            if clave:
+                return self._db.engines[clave]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': SesionAgencias})
+bp = Blueprint('tickets', __name__)
 
 # Configuración para archivos
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'doc', 'docx', 'xls', 'xlsx'}
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+def create_app():
+    from dotenv import load_dotenv
+    load_dotenv()  # Cargar variables de entorno
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
+    app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT'))
+    app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS') == 'True'
+    app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
+    app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+    app.config['TELNYX_API_KEY'] = os.getenv('TELNYX_API_KEY')
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER  # Se crea al guardar el primer archivo
+    app.config['COMPRESION_UMBRAL'] = int(os.getenv('COMPRESION_UMBRAL_BYTES', '256'))
+    app.config['JINJA_CACHE_DIR'] = os.getenv('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+    app.config['PRECARGAR_PLANTILLAS'] = os.getenv('PRECARGAR_PLANTILLAS', 'True') == 'True'
+    app.config['CACHE_AGENCIA_TTL'] = float(os.getenv('CACHE_AGENCIA_TTL', '5'))
+
+    # Agencias con base de datos propia, p. ej. {"AG01": "postgresql://..."}
+    agencias_binds = json.loads(os.getenv('AGENCIAS_BINDS') or '{}')
+    app.config['AGENCIAS_BINDS'] = {agencia: f'agencia_{agencia}' for agencia in agencias_binds}
+    app.config['SQLALCHEMY_BINDS'] = {f'agencia_{agencia}': uri for agencia, uri in agencias_binds.items()}
+
+    # Límites de peticiones: 'capacidad/segundos' por bucket de tokens; vacío lo desactiva.
+    # Todos los SMS entrantes llegan desde las pocas IPs de Telnyx, así que el
+    # límite por IP del webhook está desactivado y el control es por teléfono.
+    app.config['RATE_LIMIT_BACKEND'] = os.getenv('RATE_LIMIT_BACKEND', 'memoria')  # 'memoria' o 'sqlite'
+    app.config['RATE_LIMIT_SQLITE_PATH'] = os.getenv('RATE_LIMIT_SQLITE_PATH', os.path.join(app.instance_path, 'limites.db'))
+    app.config['LIMITES'] = {
+        'webhook_ip': os.getenv('LIMITE_WEBHOOK_IP', ''),
+        'webhook_telefono': os.getenv('LIMITE_WEBHOOK_TELEFONO', '20/60'),
+        'envio_ip': os.getenv('LIMITE_ENVIO_IP', '30/60'),
+        'envio_ticket': os.getenv('LIMITE_ENVIO_TICKET', '5/60'),
+    }
+
+    # Caché de bytecode de Jinja compartida entre workers y reinicios
+    if app.config['JINJA_CACHE_DIR']:
+        from jinja2 import FileSystemBytecodeCache
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = {**app.jinja_options,
+                             'bytecode_cache': FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])}
+
+    db.init_app(app)
+    app.register_blueprint(bp)
+    app.extensions['limitador'] = crear_limitador(app)
+
+    if app.config['PRECARGAR_PLANTILLAS']:
+        precargar_plantillas(app)
+
+    return app
+
+def precargar_plantillas(app):
+    """Compila todas las plantillas para que la primera petición no lo haga.
+
+    Con ``preload_app`` de gunicorn se ejecuta una sola vez en el proceso
+    maestro y los workers heredan las plantillas ya compiladas.
+    """
+    for nombre in app.jinja_env.list_templates():
+        app.jinja_env.get_template(nombre)
+
+def obtener_mail():
+    if 'mail' not in current_app.extensions:
+        from flask_mail import Mail
+        Mail(current_app)
+    return current_app.extensions['mail']
+
+def obtener_telnyx():
+    import telnyx
+    telnyx.api_key = current_app.config['TELNYX_API_KEY']
+    return telnyx
+
+def crear_tablas():
+    """Crea tablas e índices faltantes en la base principal y en la de cada agencia."""
+    engines = [db.engine] + [db.engines[clave] for clave in current_app.config['AGENCIAS_BINDS'].values()]
+    for engine in engines:
+        db.metadata.create_all(engine)
+        # create_all no agrega índices nuevos a tablas que ya existen
+        for tabla in db.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                indice.create(engine, checkfirst=True)
+
+# Límite de peticiones con buckets de tokens
+class LimitadorMemoria:
+    """Buckets de tokens en memoria; cada worker lleva su propia cuenta.
+
+    Guarda como máximo ``maximo`` buckets y descarta el usado hace más tiempo,
+    así que cada consulta cuesta lo mismo aunque lleguen muchas claves distintas.
+    """
+
+    def __init__(self, maximo=10000):
+        self._buckets = OrderedDict()
+        self._maximo = maximo
+        self._lock = threading.Lock()
+
+    def consumir(self, clave, capacidad, segundos):
+        """Gasta un token y devuelve 0, o los segundos a esperar si no hay."""
+        tasa = capacidad / segundos
+        ahora = time.monotonic()
+        with self._lock:
+            tokens, actualizado = self._buckets.pop(clave, (capacidad, ahora))
+            tokens = min(capacidad, tokens + (ahora - actualizado) * tasa)
+            espera = 0 if tokens >= 1 else (1 - tokens) / tasa
+            if tokens >= 1:
+                tokens -= 1
+            self._buckets[clave] = (tokens, ahora)
+            if len(self._buckets) > self._maximo:
+                self._buckets.popitem(last=False)
+        return espera
+
+class LimitadorSQLite:
+    """Buckets de tokens en un archivo SQLite compartido por todos los workers."""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._consumos = 0
+
+    def _conexion(self):
+        # Una conexión por hilo y proceso (los workers de gunicorn se crean con fork)
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+            # Espera corta: con el archivo ocupado es mejor responder 429 que bloquear el worker
+            conexion = sqlite3.connect(self.ruta, timeout=0.25, isolation_level=None)
+            conexion.execute('PRAGMA journal_mode=WAL')
+            # Con WAL basta NORMAL: no hace fsync en cada consulta del límite
+            conexion.execute('PRAGMA synchronous=NORMAL')
+            conexion.execute('CREATE TABLE IF NOT EXISTS buckets '
+                             '(clave TEXT PRIMARY KEY, tokens REAL NOT NULL, actualizado REAL NOT NULL)')
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return self._local.conexion
+
+    def consumir(self, clave, capacidad, segundos):
+        tasa = capacidad / segundos
+        ahora = time.time()
+        conexion = self._conexion()
+        conexion.execute('BEGIN IMMEDIATE')
+        try:
+            fila = conexion.execute('SELECT tokens, actualizado FROM buckets WHERE clave = ?', (clave,)).fetchone()
+            tokens, actualizado = fila if fila else (capacidad, ahora)
+            tokens = min(capacidad, tokens + max(0, ahora - actualizado) * tasa)
+            espera = 0 if tokens >= 1 else (1 - tokens) / tasa
+            if tokens >= 1:
+                tokens -= 1
+            conexion.execute('INSERT OR REPLACE INTO buckets (clave, tokens, actualizado) VALUES (?, ?, ?)',
+                             (clave, tokens, ahora))
+            self._consumos += 1
+            if self._consumos % 1000 == 0:
+                conexion.execute('DELETE FROM buckets WHERE actualizado < ?', (ahora - 24 * 3600,))
+            conexion.execute('COMMIT')
+        except Exception:
+            conexion.execute('ROLLBACK')
+            raise
+        return espera
+
+def crear_limitador(app):
+    if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+        return LimitadorSQLite(app.config['RATE_LIMIT_SQLITE_PATH'])
+    return LimitadorMemoria()
+
+def verificar_limites(*limites):
+    """Consume un token de cada ``(nombre_limite, valor)``.
+
+    Devuelve una respuesta 429 con Retry-After si alguno se agotó, o None.
+    Si el almacén compartido está bloqueado también responde 429.
+    """
+    for nombre, valor in limites:
+        if not current_app.config['LIMITES'][nombre]:
+            continue
+        capacidad, segundos = current_app.config['LIMITES'][nombre].split('/')
+        try:
+            espera = current_app.extensions['limitador'].consumir(
+                f'{nombre}:{valor}', float(capacidad), float(segundos))
+        except sqlite3.OperationalError as e:
+            print(f"Almacén de límites ocupado: {str(e)}")
+            espera = 1
+        if espera:
+            respuesta = jsonify({
+                'success': False,
+                'message': 'Demasiadas solicitudes, intente de nuevo más tarde'
+            })
+            return respuesta, 429, {'Retry-After': str(math.ceil(espera))}
+    return None
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Compresión de textos grandes (comentarios e historial)
+COMPRESION_MARCA = 'z1:'
+
+# Diccionario compartido con el texto que más se repite en los correos,
+# el historial JSON y los mensajes SMS. No modificar: los valores ya
+# guardados con la marca 'z1:' dependen de él. Si cambia, crear 'z2:'.
+COMPRESION_DICCIONARIOS = {
+    COMPRESION_MARCA: (
+        '{"fecha": "2024-01-01 00:00:00", "tipo": "Email", "destinatario": '
+        '{"fecha": "2024-01-01 00:00:00", "tipo": "Reenvío", "destinatario": '
+        '{"fecha": "2024-01-01 00:00:00", "tipo": "SMS", "destinatario": "+1'
+        '", "mensaje": "\\n        Detalles del Ticket:\\n        \\n'
+        '        Título: \\n        Descripción: \\n        Estado: '
+        '\\n        Agente: \\n        Fecha: \\n        Agencia: '
+        '\\n        \\n        Por favor, no responda a este correo automático.\\n        '
+        '", "estado": "enviado"}, '
+        'Estimado/a ,\\n\\n        Se le reenvía la información del siguiente ticket:'
+        'Nuevo En Progreso Resuelto Cerrado Sistema SMS SMS Automático '
+        '@sms.sistema.com Por favor, no responda a este correo automático.'
+    ).encode('utf-8'),
+}
+
+class TextoComprimido(TypeDecorator):
+    """Texto guardado comprimido con zlib y un diccionario compartido.
+
+    Los valores cortos y los registros antiguos se guardan tal cual, así que
+    la columna sigue siendo TEXT y no requiere migración.
+    """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        datos = value.encode('utf-8')
+        # Un texto que empiece con la marca se comprime siempre para no confundirlo
+        if len(datos) < current_app.config['COMPRESION_UMBRAL'] and not value.startswith(COMPRESION_MARCA):
+            return value
+        compresor = zlib.compressobj(9, zdict=COMPRESION_DICCIONARIOS[COMPRESION_MARCA])
+        comprimido = compresor.compress(datos) + compresor.flush()
+        return COMPRESION_MARCA + base64.b64encode(comprimido).decode('ascii')
+
+    def process_result_value(self, value, dialect):
+        if not value:
+            return value
+        marca = value[:len(COMPRESION_MARCA)]
+        if marca not in COMPRESION_DICCIONARIOS:
+            return value
+        try:
+            descompresor = zlib.decompressobj(zdict=COMPRESION_DICCIONARIOS[marca])
+            datos = base64.b64decode(value[len(marca):], validate=True)
+            return (descompresor.decompress(datos) + descompresor.flush()).decode('utf-8')
+        except (binascii.Error, zlib.error, UnicodeDecodeError):
+            # Texto antiguo que casualmente empieza con la marca
+            return value
+
+# Agencias: cada petición puede limitarse a los tickets de una agencia
+def agencia_actual():
+    """Código de agencia de la petición actual, o None para ver todas."""
+    return g.get('agencia')
+
+def bind_de_agencia(agencia):
+    if not agencia:
+        return None
+    return current_app.config['AGENCIAS_BINDS'].get(agencia)
+
+def base_actual():
+    """Nombre de la base de datos de la petición actual.
+
+    Los ids de ticket se repiten entre la base principal y la de cada agencia,
+    así que todo lo que se guarde por id debe incluirlo.
+    """
+    return bind_de_agencia(agencia_actual()) or 'principal'
+
+def carpeta_ticket(ticket_id):
+    """Carpeta de adjuntos de un ticket, separada por base de datos."""
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], secure_filename(base_actual()), str(ticket_id))
+
+class CacheAgencias:
+    """Caché en memoria por agencia con expiración corta.
+
+    Cada worker tiene la suya: los cambios hechos en el mismo worker la
+    invalidan al momento y la expiración limita el desfase con los demás.
+    """
+
+    def __init__(self):
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, agencia, clave, calcular):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get((agencia, clave))
+        if entrada and ahora - entrada[0] < current_app.config['CACHE_AGENCIA_TTL']:
+            return entrada[1]
+        valor = calcular()
+        with self._lock:
+            self._datos[(agencia, clave)] = (ahora, valor)
+        return valor
+
+    def invalidar(self, agencia):
+        # La vista sin agencia (None) incluye los tickets de todas
+        with self._lock:
+            for llave in [llave for llave in self._datos if llave[0] in (agencia, None)]:
+                del self._datos[llave]
+
+cache_agencias = CacheAgencias()
+
 class Comentario(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    contenido = db.Column(db.Text, nullable=False)
+    contenido = db.Column(TextoComprimido, nullable=False)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
-    ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False)
+    ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False, index=True)
     autor = db.Column(db.String(100), nullable=False)
     
     # Relación con archivos adjuntos
@@ -55,6 +353,13 @@ class Archivo(db.Model):
     fecha_subida = db.Column(db.DateTime, default=datetime.utcnow)
     comentario_id = db.Column(db.Integer, db.ForeignKey('comentario.id'), nullable=False)
 
+    @staticmethod
+    def obtener_o_404(id):
+        query = Archivo.query.filter(Archivo.id == id)
+        if agencia_actual():
+            query = query.join(Comentario).join(Ticket).filter(Ticket.codigo_agencia == agencia_actual())
+        return query.first_or_404()
+
 class CambioTicket(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=False)
@@ -65,9 +370,17 @@ class CambioTicket(db.Model):
     autor = db.Column(db.String(100), nullable=False)
 
 class Ticket(db.Model):
+    # Índices compuestos que empiezan por la agencia para las consultas por agencia
+    __table_args__ = (
+        db.Index('ix_ticket_agencia_estado', 'codigo_agencia', 'estado'),
+        db.Index('ix_ticket_agencia_telefono', 'codigo_agencia', 'telefono'),
+        db.Index('ix_ticket_agencia_fecha_creacion', 'codigo_agencia', 'fecha_creacion'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     titulo = db.Column(db.String(100), nullable=False)
-    descripcion = db.Column(db.Text, nullable=False)
+    # La descripción queda sin comprimir para que la búsqueda la filtre en SQL
+    descripcion = db.deferred(db.Column(db.Text, nullable=False), group='textos')
     estado = db.Column(db.String(20), default='Nuevo')
     prioridad = db.Column(db.String(10), default='Media')  # Nueva columna
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
@@ -75,7 +388,7 @@ class Ticket(db.Model):
     agente = db.Column(db.String(100), nullable=False)
     fecha_ticket = db.Column(db.DateTime, nullable=False)
     correo_agencia = db.Column(db.String(100), nullable=False)
-    historial_reenvios = db.Column(db.Text, default='')  # Almacenará el historial en formato JSON
+    historial_reenvios = db.deferred(db.Column(TextoComprimido, default=''), group='textos')  # Almacenará el historial en formato JSON
     telefono = db.Column(db.String(20))  # Nuevo campo para teléfono
     fecha_limite = db.Column(db.DateTime)  # Nueva columna para deadline
     tiempo_estimado = db.Column(db.Integer)  # Tiempo estimado en horas
@@ -118,6 +431,27 @@ class Ticket(db.Model):
                 horas = tiempo_restante.seconds // 3600
                 return f"Faltan {horas} horas"
 
+    @staticmethod
+    def de_agencia():
+        """Consulta de tickets limitada a la agencia de la petición actual."""
+        query = Ticket.query
+        if agencia_actual():
+            query = query.filter(Ticket.codigo_agencia == agencia_actual())
+        return query
+
+    @staticmethod
+    def obtener_o_404(id):
+        return Ticket.de_agencia().filter(Ticket.id == id).first_or_404()
+
+    @staticmethod
+    def contar_por_estado():
+        """Número de tickets por estado de la agencia actual (en caché)."""
+        def calcular():
+            filas = Ticket.de_agencia().with_entities(Ticket.estado, func.count(Ticket.id)) \
+                .group_by(Ticket.estado).all()
+            return dict(filas)
+        return cache_agencias.obtener(agencia_actual(), 'conteo_por_estado', calcular)
+
     @staticmethod
     def buscar(
         termino_busqueda=None, 
@@ -128,7 +462,9 @@ class Ticket(db.Model):
         orden_por='fecha_creacion',
         orden='desc'
     ):
-        query = Ticket.query
+        # El tablero muestra la descripción en cada tarjeta, así que se carga en
+        # la misma consulta; el historial se pide al abrir su modal
+        query = Ticket.de_agencia().options(undefer(Ticket.descripcion))
 
         # Búsqueda por texto
         if termino_busqueda:
@@ -157,7 +493,37 @@ class Ticket(db.Model):
 
         return query.all()
 
-@app.route('/')
+@event.listens_for(SesionAgencias, 'after_flush')
+def invalidar_cache_agencias(session, flush_context):
+    agencias = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Ticket):
+            agencias.add(obj.codigo_agencia)
+        elif isinstance(obj, Comentario):
+            ticket = session.identity_map.get(identity_key(Ticket, obj.ticket_id))
+            agencias.add(ticket.codigo_agencia if ticket else agencia_actual())
+    for agencia in agencias:
+        cache_agencias.invalidar(agencia)
+
+@bp.before_app_request
+def resolver_agencia():
+    # La agencia llega por parámetro (se recuerda en una cookie), cabecera o cookie
+    if 'agencia' in request.args:
+        agencia = request.args['agencia']
+    else:
+        agencia = request.headers.get('X-Agencia') or request.cookies.get('agencia')
+    g.agencia = agencia.strip() if agencia and agencia.strip() else None
+
+@bp.after_app_request
+def recordar_agencia(response):
+    if 'agencia' in request.args:
+        if g.agencia:
+            response.set_cookie('agencia', g.agencia, samesite='Lax')
+        else:
+            response.delete_cookie('agencia')
+    return response
+
+@bp.route('/')
 def index():
     # Obtener parámetros de búsqueda y filtros
     busqueda = request.args.get('busqueda', '')
@@ -187,6 +553,7 @@ def index():
 
     return render_template('index.html', 
                          tickets=tickets, 
+                         agencia=agencia_actual(),
                          filtros_activos={
                              'busqueda': busqueda,
                              'estado': estado,
@@ -197,12 +564,17 @@ def index():
                              'orden': orden
                          })
 
-@app.route('/ticket/nuevo', methods=['POST'])
+@bp.route('/ticket/nuevo', methods=['POST'])
 def crear_ticket():
     if request.method == 'POST':
         titulo = request.form['titulo']
         descripcion = request.form['descripcion']
         codigo_agencia = request.form['codigo_agencia']
+        if agencia_actual() and codigo_agencia != agencia_actual():
+            return jsonify({
+                'success': False,
+                'message': f'El código de agencia debe ser {agencia_actual()} mientras trabaja en esa agencia'
+            }), 400
         agente = request.form['agente']
         fecha_ticket = datetime.strptime(request.form['fecha_ticket'], '%Y-%m-%d')
         correo_agencia = request.form['correo_agencia']
@@ -225,19 +597,19 @@ def crear_ticket():
         )
         db.session.add(nuevo_ticket)
         db.session.commit()
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
-@app.route('/ticket/mover/<int:id>', methods=['POST'])
+@bp.route('/ticket/mover/<int:id>', methods=['POST'])
 def mover_ticket(id):
-    ticket = Ticket.query.get_or_404(id)
+    ticket = Ticket.obtener_o_404(id)
     nuevo_estado = request.form['estado']
     ticket.estado = nuevo_estado
     db.session.commit()
     return jsonify({'success': True})
 
-@app.route('/ticket/editar/<int:id>', methods=['GET', 'POST'])
+@bp.route('/ticket/editar/<int:id>', methods=['GET', 'POST'])
 def editar_ticket(id):
-    ticket = Ticket.query.get_or_404(id)
+    ticket = Ticket.obtener_o_404(id)
     if request.method == 'POST':
         try:
             # Registrar cambios
@@ -265,20 +637,22 @@ def editar_ticket(id):
             
     return jsonify({'success': False, 'message': 'Método no permitido'})
 
-@app.route('/ticket/eliminar/<int:id>', methods=['POST'])
+@bp.route('/ticket/eliminar/<int:id>', methods=['POST'])
 def eliminar_ticket(id):
     try:
-        ticket = Ticket.query.get_or_404(id)
+        ticket = Ticket.obtener_o_404(id)
         
         # Eliminar archivos físicos asociados a los comentarios
+        carpetas = {carpeta_ticket(id)}
         for comentario in ticket.comentarios:
             for archivo in comentario.archivos:
                 if os.path.exists(archivo.ruta):
                     os.remove(archivo.ruta)
+                carpetas.add(os.path.dirname(archivo.ruta))
             
-            # Eliminar el directorio del ticket si existe
-            ticket_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(id))
-            if os.path.exists(ticket_folder):
+        # Eliminar los directorios del ticket que existan y hayan quedado vacíos
+        for ticket_folder in carpetas:
+            if os.path.exists(ticket_folder) and not os.listdir(ticket_folder):
                 os.rmdir(ticket_folder)
         
         db.session.delete(ticket)
@@ -288,20 +662,28 @@ def eliminar_ticket(id):
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)})
 
-@app.route('/ticket/completar/<int:id>', methods=['POST'])
+@bp.route('/ticket/completar/<int:id>', methods=['POST'])
 def completar_ticket(id):
-    ticket = Ticket.query.get_or_404(id)
+    ticket = Ticket.obtener_o_404(id)
     ticket.estado = 'Resuelto'  # o 'Cerrado' según prefieras
     db.session.commit()
     return jsonify({'success': True})
 
-@app.route('/ticket/enviar_correo/<int:id>', methods=['POST'])
+@bp.route('/ticket/enviar_correo/<int:id>', methods=['POST'])
 def enviar_correo(id):
-    ticket = Ticket.query.get_or_404(id)
+    limite = verificar_limites(('envio_ip', request.remote_addr))
+    if limite:
+        return limite
+    ticket = Ticket.obtener_o_404(id)
+    limite = verificar_limites(('envio_ticket', f'correo:{base_actual()}:{id}'))
+    if limite:
+        return limite
     try:
+        from flask_mail import Message
+        mail = obtener_mail()
         msg = Message(
             'Actualización de Ticket #{}'.format(ticket.id),
-            sender=app.config['MAIL_USERNAME'],
+            sender=current_app.config['MAIL_USERNAME'],
             recipients=[ticket.correo_agencia]
         )
         msg.body = f"""
@@ -337,17 +719,25 @@ def enviar_correo(id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
-@app.route('/ticket/reenviar/<int:id>', methods=['POST'])
+@bp.route('/ticket/reenviar/<int:id>', methods=['POST'])
 def reenviar_correo(id):
-    ticket = Ticket.query.get_or_404(id)
+    limite = verificar_limites(('envio_ip', request.remote_addr))
+    if limite:
+        return limite
+    ticket = Ticket.obtener_o_404(id)
+    limite = verificar_limites(('envio_ticket', f'correo:{base_actual()}:{id}'))
+    if limite:
+        return limite
     correo_destino = request.form.get('correo_destino')
     nombre_destino = request.form.get('nombre_destino')
     mensaje_adicional = request.form.get('mensaje_adicional', '')
     
     try:
+        from flask_mail import Message
+        mail = obtener_mail()
         msg = Message(
             'Información de Ticket #{}'.format(ticket.id),
-            sender=app.config['MAIL_USERNAME'],
+            sender=current_app.config['MAIL_USERNAME'],
             recipients=[correo_destino]
         )
         msg.body = f"""
@@ -388,31 +778,36 @@ def reenviar_correo(id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
-@app.route('/ticket/obtener_correo/<int:id>', methods=['GET'])
+@bp.route('/ticket/obtener_correo/<int:id>', methods=['GET'])
 def obtener_correo(id):
-    ticket = Ticket.query.get_or_404(id)
+    ticket = Ticket.obtener_o_404(id)
     return jsonify({
         'correo': ticket.correo_agencia,
         'codigo_agencia': ticket.codigo_agencia,
         'telefono': ticket.telefono
     })
 
-@app.template_filter('json_loads')
+@bp.route('/ticket/<int:id>/historial', methods=['GET'])
+def obtener_historial(id):
+    ticket = Ticket.obtener_o_404(id)
+    return jsonify({'historial': json_loads_filter(ticket.historial_reenvios)})
+
+@bp.app_template_filter('json_loads')
 def json_loads_filter(value):
     try:
         return json.loads(value) if value else []
     except:
         return []
 
-@app.template_filter('nl2br')
+@bp.app_template_filter('nl2br')
 def nl2br_filter(text):
     if not text:
         return ""
     return text.replace('\n', '<br>')
 
-@app.route('/ticket/duplicar/<int:id>', methods=['POST'])
+@bp.route('/ticket/duplicar/<int:id>', methods=['POST'])
 def duplicar_ticket(id):
-    ticket_original = Ticket.query.get_or_404(id)
+    ticket_original = Ticket.obtener_o_404(id)
     try:
         nuevo_ticket = Ticket(
             titulo=f"Copia de - {ticket_original.titulo}",
@@ -433,8 +828,12 @@ def duplicar_ticket(id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
-@app.route('/webhook/sms', methods=['POST'])
+@bp.route('/webhook/sms', methods=['POST'])
 def webhook_sms():
+    limite = verificar_limites(('webhook_ip', request.remote_addr))
+    if limite:
+        return limite
+
     try:
         # Obtener datos del webhook de Telyx
         data = request.get_json()
@@ -452,9 +851,14 @@ def webhook_sms():
         mensaje = data['data']['payload'].get('text', '')
         telefono_origen = data['data']['payload']['from'].get('phone_number', '')
         fecha_sms = datetime.now()
+
+        limite = verificar_limites(('webhook_telefono', f'{agencia_actual() or ""}:{telefono_origen}'))
+        if limite:
+            print(f"Límite de mensajes excedido para: {telefono_origen}")
+            return limite
         
         # Buscar ticket existente con el mismo teléfono y que no esté cerrado
-        ticket_existente = Ticket.query.filter(
+        ticket_existente = Ticket.de_agencia().filter(
             Ticket.telefono == telefono_origen,
             Ticket.estado != 'Resuelto',
             Ticket.estado != 'Cerrado'
@@ -477,7 +881,7 @@ def webhook_sms():
             nuevo_ticket = Ticket(
                 titulo=f"SMS desde {telefono_origen}",
                 descripcion=mensaje,
-                codigo_agencia=telefono_origen,
+                codigo_agencia=agencia_actual() or telefono_origen,
                 agente="Sistema SMS",
                 fecha_ticket=fecha_sms,
                 correo_agencia=f"{telefono_origen}@sms.sistema.com",
@@ -494,9 +898,15 @@ def webhook_sms():
         print(f"Error en webhook SMS: {str(e)}")
         return jsonify({'success': False, 'message': str(e)})
 
-@app.route('/ticket/enviar_sms/<int:id>', methods=['POST'])
+@bp.route('/ticket/enviar_sms/<int:id>', methods=['POST'])
 def enviar_sms(id):
-    ticket = Ticket.query.get_or_404(id)
+    limite = verificar_limites(('envio_ip', request.remote_addr))
+    if limite:
+        return limite
+    ticket = Ticket.obtener_o_404(id)
+    limite = verificar_limites(('envio_ticket', f'sms:{base_actual()}:{id}'))
+    if limite:
+        return limite
     numero_destino = ticket.telefono or request.form.get('numero_destino')
     mensaje = request.form.get('mensaje')
     
@@ -532,7 +942,7 @@ def enviar_sms(id):
         print(f"Enviando SMS desde: {numero_origen} a: {numero_destino}")
 
         # Enviar SMS usando Telnyx
-        mensaje_enviado = telnyx.Message.create(
+        mensaje_enviado = obtener_telnyx().Message.create(
             from_=numero_origen,
             to=numero_destino,
             text=mensaje,
@@ -567,9 +977,9 @@ def enviar_sms(id):
             'message': f'Error al enviar SMS: {error_detail}'
         })
 
-@app.route('/ticket/<int:ticket_id>/comentario', methods=['POST'])
+@bp.route('/ticket/<int:ticket_id>/comentario', methods=['POST'])
 def agregar_comentario(ticket_id):
-    ticket = Ticket.query.get_or_404(ticket_id)
+    ticket = Ticket.obtener_o_404(ticket_id)
     contenido = request.form.get('contenido')
     autor = request.form.get('autor', 'Usuario')  # En el futuro, esto vendrá del sistema de usuarios
     
@@ -586,7 +996,7 @@ def agregar_comentario(ticket_id):
         if archivo and allowed_file(archivo.filename):
             filename = secure_filename(archivo.filename)
             # Crear subdirectorio para el ticket si no existe
-            ticket_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(ticket_id))
+            ticket_folder = carpeta_ticket(ticket_id)
             if not os.path.exists(ticket_folder):
                 os.makedirs(ticket_folder)
             
@@ -613,14 +1023,14 @@ def agregar_comentario(ticket_id):
         }
     })
 
-@app.route('/archivo/<int:archivo_id>')
+@bp.route('/archivo/<int:archivo_id>')
 def descargar_archivo(archivo_id):
-    archivo = Archivo.query.get_or_404(archivo_id)
+    archivo = Archivo.obtener_o_404(archivo_id)
     return send_file(archivo.ruta, as_attachment=True)
 
-@app.route('/archivo/<int:archivo_id>/eliminar', methods=['POST'])
+@bp.route('/archivo/<int:archivo_id>/eliminar', methods=['POST'])
 def eliminar_archivo(archivo_id):
-    archivo = Archivo.query.get_or_404(archivo_id)
+    archivo = Archivo.obtener_o_404(archivo_id)
     try:
         # Eliminar el archivo físico
         if os.path.exists(archivo.ruta):
@@ -652,7 +1062,7 @@ def registrar_cambio(ticket, campo, valor_anterior, valor_nuevo, autor='Sistema'
         )
         db.session.add(cambio)
 
-@app.route('/vista/<string:tipo>')
+@bp.route('/vista/<string:tipo>')
 def vista(tipo):
     # Obtener parámetros comunes
     busqueda = request.args.get('busqueda', '')
@@ -723,14 +1133,27 @@ def vista(tipo):
                              filtros_activos=request.args)
     
     # Por defecto, redirigir a vista Kanban
-    return redirect(url_for('vista', tipo='kanban'))
+    return redirect(url_for('.vista', tipo='kanban'))
 
-@app.route('/check-nuevos-mensajes')
+@bp.route('/check-nuevos-mensajes')
 def check_nuevos_mensajes():
     ultimo_id = request.args.get('ultimo_id', 0, type=int)
-    
+    agencia = agencia_actual()
+
+    query = Comentario.query
+    if agencia:
+        query = query.join(Ticket).filter(Ticket.codigo_agencia == agencia)
+
+    # Sin comentarios nuevos en la agencia no hace falta consultar más
+    maximo_id = cache_agencias.obtener(
+        agencia, 'ultimo_comentario',
+        lambda: query.with_entities(func.max(Comentario.id)).scalar() or 0
+    )
+    if ultimo_id >= maximo_id:
+        return jsonify({'nuevosMensajes': []})
+
     # Buscar comentarios más nuevos que el último ID
-    nuevos_comentarios = Comentario.query.filter(
+    nuevos_comentarios = query.filter(
         Comentario.id > ultimo_id
     ).order_by(Comentario.fecha_creacion.desc()).limit(10).all()
     
@@ -743,7 +1166,15 @@ def check_nuevos_mensajes():
         } for c in nuevos_comentarios]
     })
 
+@bp.route('/agencia/resumen')
+def resumen_agencia():
+    return jsonify({
+        'agencia': agencia_actual(),
+        'conteo_por_estado': Ticket.contar_por_estado()
+    })
+
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
+        crear_tablas()
     app.run(debug=True, port=5003)
@@ -0,0 +1,94 @@
+"""Compara el tamaño de la base de datos y el tiempo de carga del tablero
+con y sin compresión de textos.
+
+Uso:
+    python benchmarks/bench_almacenamiento.py [num_tickets]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIN_COMPRESION = str(10 ** 9)
+
+
+def medir(num_tickets):
+    sys.path.insert(0, RAIZ)
+    import json
+    from datetime import datetime
+    import app as aplicacion
+    app = aplicacion.create_app()
+
+    cuerpo = """
+        Detalles del Ticket:
+
+        Título: Cambio de fecha en reservación
+        Descripción: {}
+        Estado: Nuevo
+        Agente: Sistema SMS
+        Fecha: 2024-03-19
+
+        Por favor, no responda a este correo automático.
+        """
+    with app.app_context():
+        aplicacion.db.create_all()
+        for i in range(num_tickets):
+            descripcion = f'El cliente {i} solicita cambiar la fecha de su reservación. ' * 6
+            historial = [{
+                'fecha': '2024-03-19 10:00:00',
+                'tipo': 'Email',
+                'destinatario': f'agencia{i}@ejemplo.com',
+                'mensaje': cuerpo.format(descripcion)
+            } for _ in range(5)]
+            ticket = aplicacion.Ticket(
+                titulo=f'Ticket {i}',
+                descripcion=descripcion,
+                codigo_agencia=f'AG{i % 50}',
+                agente='Sistema SMS',
+                fecha_ticket=datetime.now(),
+                correo_agencia=f'agencia{i}@ejemplo.com',
+                historial_reenvios=json.dumps(historial)
+            )
+            aplicacion.db.session.add(ticket)
+            aplicacion.db.session.add(aplicacion.Comentario(
+                contenido=cuerpo.format(descripcion), ticket=ticket, autor='SMS Automático'))
+        aplicacion.db.session.commit()
+
+    cliente = app.test_client()
+    cliente.get('/')
+    inicio = time.perf_counter()
+    repeticiones = 5
+    for _ in range(repeticiones):
+        cliente.get('/')
+    duracion = (time.perf_counter() - inicio) / repeticiones
+
+    ruta_db = os.environ['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
+    print(f'{os.path.getsize(ruta_db) / 1024:.0f} {duracion * 1000:.1f}')
+
+
+def ejecutar(umbral, num_tickets):
+    with tempfile.TemporaryDirectory() as directorio:
+        entorno = dict(
+            os.environ,
+            SQLALCHEMY_DATABASE_URI=f'sqlite:///{os.path.join(directorio, "bench.db")}',
+            MAIL_PORT=os.getenv('MAIL_PORT', '587'),
+            COMPRESION_UMBRAL_BYTES=umbral,
+        )
+        salida = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--medir', str(num_tickets)],
+            cwd=directorio, env=entorno, capture_output=True, text=True, check=True
+        ).stdout.split()
+        return float(salida[-2]), float(salida[-1])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--medir']:
+        medir(int(sys.argv[2]))
+        sys.exit(0)
+
+    num_tickets = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for nombre, umbral in (('Sin compresión', SIN_COMPRESION), ('Con compresión', '256')):
+        tamano, duracion = ejecutar(umbral, num_tickets)
+        print(f'{nombre:<16} base de datos: {tamano:>8.0f} KB   carga de /: {duracion:>8.1f} ms')
@@ -0,0 +1,68 @@
+"""Mide el tiempo de importación, de creación de la aplicación y de la
+primera petición, con y sin precarga de plantillas.
+
+Uso:
+    python benchmarks/bench_arranque.py [repeticiones]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def medir():
+    sys.path.insert(0, RAIZ)
+    inicio = time.perf_counter()
+    import app as aplicacion
+    importacion = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    app = aplicacion.create_app()
+    with app.app_context():
+        aplicacion.db.create_all()
+    creacion = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    app.test_client().get('/')
+    primera_peticion = time.perf_counter() - inicio
+
+    pesados = [m for m in ('telnyx', 'flask_mail', 'psycopg2') if m in sys.modules]
+    print(f'{importacion * 1000:.1f} {creacion * 1000:.1f} {primera_peticion * 1000:.1f} {",".join(pesados) or "-"}')
+
+
+def ejecutar(precargar, cache_dir):
+    with tempfile.TemporaryDirectory() as directorio:
+        entorno = dict(
+            os.environ,
+            SQLALCHEMY_DATABASE_URI=f'sqlite:///{os.path.join(directorio, "bench.db")}',
+            MAIL_PORT=os.getenv('MAIL_PORT', '587'),
+            PRECARGAR_PLANTILLAS=precargar,
+            JINJA_CACHE_DIR=cache_dir,
+        )
+        salida = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--medir'],
+            cwd=directorio, env=entorno, capture_output=True, text=True, check=True
+        ).stdout.split()
+        return [float(v) for v in salida[-4:-1]] + [salida[-1]]
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--medir']:
+        medir()
+        sys.exit(0)
+
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as cache_dir:
+        casos = (
+            ('Sin precarga', 'False', ''),
+            ('Con precarga', 'True', ''),
+            ('Precarga+caché', 'True', cache_dir),
+        )
+        for nombre, precargar, directorio in casos:
+            resultados = [ejecutar(precargar, directorio) for _ in range(repeticiones)]
+            promedio = [sum(r[i] for r in resultados) / repeticiones for i in range(3)]
+            print(f'{nombre:<15} import: {promedio[0]:>7.1f} ms   create_app: {promedio[1]:>7.1f} ms   '
+                  f'primera petición: {promedio[2]:>7.1f} ms   módulos pesados: {resultados[-1][3]}')
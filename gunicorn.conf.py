@@ -0,0 +1,18 @@
+# Configuración de gunicorn: gunicorn -c gunicorn.conf.py
+import os
+
+wsgi_app = 'app:create_app()'
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5003')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+
+# La aplicación y sus plantillas se preparan una vez en el proceso maestro
+# y los workers nuevos (autoescalado o reciclaje) arrancan ya listos.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Las conexiones a la base de datos no se comparten entre procesos
+    from app import db
+    with worker.app.wsgi().app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)